@@ -0,0 +1,78 @@
+##########
+# 首页渲染的性能测试
+##########
+
+# 比较 Flask 自带的 url_for 和 flaskr/urls.py 中缓存的 url_for ，渲染带有 100 个帖子的首页。
+# 在项目根目录运行，项目没有安装时需要把根目录加入 PYTHONPATH ：
+# $ PYTHONPATH=. python benchmarks/bench_index.py
+# (Windows)
+# $ $env:PYTHONPATH = "."; python benchmarks/bench_index.py
+
+import os
+import tempfile
+import timeit
+
+from flask import render_template_string, url_for
+
+from flaskr import create_app
+from flaskr.db import get_db, init_db
+
+POSTS = 100
+NUMBER = 200
+
+# 与教程中 blog/index.html 的结构相同，每个帖子都会调用一次 url_for 。
+INDEX = """
+{% extends 'base.html' %}
+{% block content %}
+    {% for post in posts %}
+        <article class="post">
+            <header>
+                <h1><a href="{{ url_for('index', post=post['id']) }}">{{ post['title'] }}</a></h1>
+                <div class="about">by {{ post['username'] }} on {{ post['created'].strftime('%Y-%m-%d') }}</div>
+            </header>
+            <p class="body">{{ post['body'] }}</p>
+        </article>
+    {% endfor %}
+{% endblock %}
+"""
+
+def main():
+    db_fd, db_path = tempfile.mkstemp()
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': db_path,
+        'DB_MAINTENANCE_INTERVAL': 0,
+    })
+    cached_url_for = app.jinja_env.globals['url_for']
+
+    with app.test_request_context('/'):
+        init_db()
+        db = get_db()
+        db.execute(
+            "INSERT INTO user (username, password) VALUES ('test', 'test')"
+        )
+        db.executemany(
+            'INSERT INTO post (title, body, author_id) VALUES (?, ?, 1)',
+            [(f'title {i}', f'body {i}') for i in range(POSTS)],
+        )
+        db.commit()
+        posts = db.execute(
+            'SELECT p.id, title, body, created, author_id, username '
+            'FROM post p JOIN user u ON p.author_id = u.id '
+            'ORDER BY created DESC'
+        ).fetchall()
+
+        def render():
+            return render_template_string(INDEX, posts=posts)
+
+        for name, func in (('url_for', url_for), ('cached url_for', cached_url_for)):
+            app.jinja_env.globals['url_for'] = func
+            render()
+            seconds = min(timeit.repeat(render, number=NUMBER, repeat=5))
+            print(f'{name:>15}: {seconds / NUMBER * 1000:.3f} ms/render')
+
+    os.close(db_fd)
+    os.unlink(db_path)
+
+if __name__ == '__main__':
+    main()
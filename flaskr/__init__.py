@@ -78,6 +78,16 @@ def create_app(test_config=None):
 
         # DATABASE SQLite 数据库文件存放在路径。它位于 Flask 用于存放实例的 app.instance_path 之内。
         DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+
+        # 后台数据库维护的间隔，以及判定为低访问量所需的空闲时间，单位为秒。
+        DB_MAINTENANCE_INTERVAL=3600,
+        DB_MAINTENANCE_IDLE=60,
+
+        # flask backup 保存备份文件的文件夹。
+        BACKUP_DIR=os.path.join(app.instance_path, 'backups'),
+
+        # 模板中缓存的 URL 的最大数量。
+        URL_CACHE_SIZE=1024,
     )
 
     # 载入这个实例设置，如果存在就不测试
@@ -149,5 +159,10 @@ def create_app(test_config=None):
     app.register_blueprint(blog.bp)
     app.add_url_rule('/', endpoint='index')
 
+    # 所有蓝图注册以后，让模板使用缓存的 url_for 。
+    # --> urls.py
+    from . import urls
+    urls.init_app(app)
+
     return app
 
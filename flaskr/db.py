@@ -16,7 +16,17 @@
 # 在网络应用中连接往往与请求绑定。在处理请求的某个时刻，连接被创建。
 # 在发送响应 之前连接被关闭。
 
+import gzip
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
 
 import click
 
@@ -74,6 +84,354 @@ def init_db_command():
     init_db()
     click.echo('初始化数据库。')
 
+#####
+# 数据库维护
+#####
+
+# 大量删除之后 SQLite 文件不会自动缩小，查询规划器也没有统计信息可用，
+# 而在 WAL 模式下 -wal 文件会在持续读取时不断增长。
+# 这里提供一个维护函数，在访问量低的时候由后台线程调用，也可以通过 flask db-maintain 手动运行。
+
+def maintain_db(database, checkpoint='PASSIVE'):
+    """运行 ANALYZE 、 incremental_vacuum 和 wal_checkpoint ，返回维护结果。
+    """
+    # 维护使用独立的连接，不占用请求中 g.db 的连接。
+    db = sqlite3.connect(database)
+
+    try:
+        # ANALYZE 为查询规划器收集统计信息，保存在 sqlite_stat1 表中。
+        # 在新连接上直接运行 PRAGMA optimize 什么也不做，因为它只分析这个连接用过的表。
+        # SQLite 3.46 起 optimize=0x10002 会检查所有表；先用调试位 0x01 看看有没有需要分析的表。
+        has_stats = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ).fetchone() is not None
+
+        if has_stats and sqlite3.sqlite_version_info >= (3, 46):
+            pending = db.execute('PRAGMA optimize=0x10003').fetchall()
+            if pending:
+                db.execute('PRAGMA optimize=0x10002')
+            analyzed = bool(pending)
+
+        # 更早的版本，或者还没有统计信息时，直接运行 ANALYZE 。
+        # analysis_limit 限制每个索引只扫描大约 400 行，大表上也很快。
+        else:
+            db.execute('PRAGMA analysis_limit=400')
+            db.execute('ANALYZE')
+            analyzed = True
+
+        # incremental_vacuum 只在 auto_vacuum = INCREMENTAL 时才会回收空闲页。
+        # schema.sql 在建表之前设置了这个选项。
+        # 每执行一步只回收一页，所以要用 executescript() 让它一直执行到结束。
+        before = db.execute('PRAGMA freelist_count').fetchone()[0]
+        db.executescript('PRAGMA incremental_vacuum')
+        after = db.execute('PRAGMA freelist_count').fetchone()[0]
+
+        # wal_checkpoint 把 -wal 文件中的内容写回数据库。
+        # PASSIVE 不会阻塞读写， TRUNCATE 会等待读写完成并把 -wal 文件截断为 0 字节。
+        # schema.sql 把数据库设置为 WAL 模式；不在 WAL 模式下时这个命令什么也不做。
+        # 成功的 TRUNCATE 总是返回 (0, 0, 0) ，所以先做一次 PASSIVE 得到写回的页数，
+        # 再用 TRUNCATE 截断；TRUNCATE 等不到读写结束时返回 busy ，结果就只是 PASSIVE 。
+        wal = database + '-wal'
+        wal_before = os.path.getsize(wal) if os.path.exists(wal) else 0
+        start = time.perf_counter()
+        busy, log, checkpointed = db.execute(
+            'PRAGMA wal_checkpoint(PASSIVE)'
+        ).fetchone()
+        if checkpoint != 'PASSIVE':
+            busy = db.execute(f'PRAGMA wal_checkpoint({checkpoint})').fetchone()[0]
+            if busy:
+                checkpoint = 'PASSIVE'
+        duration = time.perf_counter() - start
+        wal_after = os.path.getsize(wal) if os.path.exists(wal) else 0
+    finally:
+        db.close()
+
+    return {
+        'analyzed': analyzed,
+        'reclaimed_pages': before - after,
+        'checkpoint': checkpoint,
+        'checkpoint_busy': bool(busy),
+        'checkpoint_pages': max(checkpointed, 0),
+        'checkpoint_seconds': duration,
+        'wal_bytes_before': wal_before,
+        'wal_bytes_after': wal_after,
+    }
+
+@click.command('db-maintain')
+@click.option('--truncate', is_flag=True, help='使用 TRUNCATE 检查点截断 -wal 文件。')
+def db_maintain_command(truncate):
+    """优化、回收空闲页并对数据库做检查点"""
+    result = maintain_db(
+        current_app.config['DATABASE'],
+        checkpoint='TRUNCATE' if truncate else 'PASSIVE',
+    )
+    click.echo('运行了 ANALYZE 。' if result['analyzed'] else '统计信息无需更新。')
+    click.echo(f"回收了 {result['reclaimed_pages']} 页。")
+    click.echo(
+        f"{result['checkpoint']} 检查点写回 {result['checkpoint_pages']} 页，"
+        f"用时 {result['checkpoint_seconds'] * 1000:.1f} ms。"
+    )
+    click.echo(
+        f"-wal 文件从 {result['wal_bytes_before']} 字节变为 {result['wal_bytes_after']} 字节。"
+    )
+
+# 后台调度器每隔 DB_MAINTENANCE_INTERVAL 秒醒来一次，
+# 只有在最近 DB_MAINTENANCE_IDLE 秒内没有请求的时候才进行维护，这样不会和正常访问抢锁。
+# 把 DB_MAINTENANCE_INTERVAL 设置为 0 可以关闭调度器。
+
+# 最近一次请求的时间记录在数据库旁边一个文件的修改时间上，
+# 这样 gunicorn -w N 的所有 worker 看到的是同一个空闲时间，而不只是自己进程中的请求。
+# 每个进程最多每秒更新一次这个文件。
+
+def start_maintenance(app):
+    interval = app.config['DB_MAINTENANCE_INTERVAL']
+    idle = app.config['DB_MAINTENANCE_IDLE']
+    activity = app.config['DATABASE'] + '-activity'
+    lock = threading.Lock()
+    state = {'thread': None, 'touched': 0.0}
+
+    # 非调试模式下 app.logger 只输出 WARNING 以上的日志，维护报告是 INFO ，会被丢掉。
+    # 没有配置日志级别时把它设为 INFO ；使用 logging.config 自己配置的级别不受影响。
+    if app.logger.level == logging.NOTSET:
+        app.logger.setLevel(logging.INFO)
+
+    def mark_request():
+        now = time.time()
+
+        if now - state['touched'] >= 1:
+            state['touched'] = now
+            with open(activity, 'a'):
+                pass
+            os.utime(activity, (now, now))
+
+    def idle_for():
+        try:
+            last_request = os.stat(activity).st_mtime
+        except OSError:
+            last_request = 0.0
+
+        return time.time() - last_request
+
+    def run():
+        while True:
+            time.sleep(interval)
+
+            # 间隔到了以后，如果最近有请求，就等到空闲时间可能满足时再检查，
+            # 而不是再等一整个间隔，否则访问不断的网站永远等不到维护。
+            elapsed = idle_for()
+            while elapsed < idle:
+                time.sleep(max(idle - elapsed, 1))
+                elapsed = idle_for()
+
+            # 空闲时使用 TRUNCATE 截断 -wal 文件，还有连接在读写时 maintain_db 会退回 PASSIVE 。
+            try:
+                result = maintain_db(app.config['DATABASE'], checkpoint='TRUNCATE')
+            except sqlite3.Error:
+                app.logger.exception('数据库维护失败')
+                continue
+
+            app.logger.info(
+                '数据库维护：ANALYZE %s，回收 %d 页，%s 检查点写回 %d 页，用时 %.1f ms，'
+                '-wal 文件从 %d 字节变为 %d 字节',
+                '已运行' if result['analyzed'] else '未运行',
+                result['reclaimed_pages'],
+                result['checkpoint'],
+                result['checkpoint_pages'],
+                result['checkpoint_seconds'] * 1000,
+                result['wal_bytes_before'],
+                result['wal_bytes_after'],
+            )
+
+    # 线程在处理第一个请求时才启动，而不是在 init_app 中。
+    # 这样 flask init-db 之类的命令和 flask run --debug 的重载父进程（它从不处理请求）都不会启动它，
+    # 使用 gunicorn --preload 时每个 fork 出来的 worker 也会有自己的线程。
+    @app.before_request
+    def maintenance_before_request():
+        mark_request()
+
+        if state['thread'] is None:
+            with lock:
+                if state['thread'] is None:
+                    # daemon=True 让线程在应用退出时自动结束。
+                    state['thread'] = threading.Thread(
+                        target=run, name='flaskr-db-maintenance', daemon=True
+                    )
+                    state['thread'].start()
+
+#####
+# 备份和恢复
+#####
+
+# 直接复制正在使用的 flaskr.sqlite 并不安全，还会阻塞写入。
+# sqlite3.Connection.backup() 使用 SQLite 的在线备份 API ，每次复制 pages 页，
+# 备份时两步之间 sleep 一段时间，这样正常访问可以继续进行。
+
+def _copy_db(source, target, pages, sleep):
+    # sqlite3.connect() 会为不存在的文件创建一个空数据库，
+    # 不检查的话会把空数据库当作备份，或者把空数据库恢复到 DATABASE 。
+    if not os.path.isfile(source):
+        raise click.ClickException(f'数据库文件不存在：{source}')
+
+    # backup() 的 sleep 参数只在数据库忙的时候才起作用，成功的两步之间并不会暂停，
+    # 所以用 progress 回调在每一步之后暂停。
+    def throttle(status, remaining, total):
+        if remaining > 0 and sleep > 0:
+            time.sleep(sleep)
+
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+
+    try:
+        src.backup(dst, pages=pages, progress=throttle)
+    finally:
+        dst.close()
+        src.close()
+
+def _check_integrity(database):
+    if not os.path.isfile(database):
+        raise click.ClickException(f'数据库文件不存在：{database}')
+
+    # 以只读方式打开，检查时不会修改或者创建文件。
+    uri = pathlib.Path(database).resolve().as_uri() + '?mode=ro'
+
+    try:
+        db = sqlite3.connect(uri, uri=True)
+        try:
+            result = db.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            db.close()
+
+    # 例如 file is not a database 。
+    except sqlite3.DatabaseError as e:
+        raise click.ClickException(f'无法读取 {database}：{e}')
+
+    if result != 'ok':
+        raise click.ClickException(f'完整性检查失败：{result}')
+
+def _file_digest(path):
+    # .gz 文件按解压后的内容计算，这样压缩与否不影响比较。
+    opener = gzip.open if path.endswith('.gz') else open
+    digest = hashlib.sha256()
+
+    with opener(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def backup_db(database, backup_dir, pages=100, sleep=0.05, compress=False,
+              incremental=False):
+    """在线备份数据库，返回备份文件的路径。没有变化而跳过时返回 None 。
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    # 文件名使用 UTC 时间并精确到微秒，夏令时切换时也能按时间排序，同一秒内的备份也不会互相覆盖。
+    name = datetime.now(timezone.utc).strftime('flaskr-%Y%m%d-%H%M%S-%fZ.sqlite')
+    fd, snapshot = tempfile.mkstemp(suffix='.tmp', prefix=name, dir=backup_dir)
+    os.close(fd)
+
+    try:
+        _copy_db(database, snapshot, pages, sleep)
+
+        # 快照会继承数据库的 WAL 模式，改回普通的回滚日志，备份就只有一个文件，
+        # 只读的完整性检查也不会在旁边留下 -wal 和 -shm 文件。
+        db = sqlite3.connect(snapshot)
+        try:
+            db.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            db.close()
+
+        # 完整性检查在快照上进行，不会占用正在使用的数据库。
+        _check_integrity(snapshot)
+
+        # 增量备份：快照和最近一次备份内容相同时不再保存新的文件。
+        if incremental:
+            backups = list_backups(backup_dir)
+            if backups and _file_digest(backups[-1]) == _file_digest(snapshot):
+                return None
+
+        path = os.path.join(backup_dir, name)
+        if compress:
+            path += '.gz'
+            with open(snapshot, 'rb') as src, gzip.open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        else:
+            os.replace(snapshot, path)
+    finally:
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+
+    return path
+
+def list_backups(backup_dir):
+    """按时间顺序列出备份文件。
+    """
+    if not os.path.isdir(backup_dir):
+        return []
+
+    return sorted(
+        os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+        if name.startswith('flaskr-') and name.endswith(('.sqlite', '.sqlite.gz'))
+    )
+
+def restore_db(database, path, pages=100, sleep=0):
+    """用备份文件覆盖数据库。
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = path
+
+        if path.endswith('.gz'):
+            snapshot = os.path.join(tmp, 'restore.sqlite')
+            try:
+                with gzip.open(path, 'rb') as src, open(snapshot, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            except OSError as e:
+                raise click.ClickException(f'无法解压 {path}：{e}')
+
+        # 先检查备份文件，损坏的备份不会写入数据库。
+        _check_integrity(snapshot)
+
+        # 反过来使用在线备份 API ，把备份写回数据库，其他连接看到的始终是完整的数据库。
+        # 写入目标数据库时写锁会一直保持到复制结束， sleep 只会让其他写入等得更久，所以缺省为 0 。
+        _copy_db(snapshot, database, pages, sleep)
+
+@click.command('backup')
+@click.option('--pages', default=100, show_default=True, help='每一步复制的页数。')
+@click.option('--sleep', default=0.05, show_default=True, help='两步之间暂停的秒数。')
+@click.option('--compress', is_flag=True, help='使用 gzip 压缩备份文件。')
+@click.option('--incremental', is_flag=True, help='没有变化时不保存新的备份。')
+def backup_command(pages, sleep, compress, incremental):
+    """在线备份数据库"""
+    path = backup_db(
+        current_app.config['DATABASE'],
+        current_app.config['BACKUP_DIR'],
+        pages=pages,
+        sleep=sleep,
+        compress=compress,
+        incremental=incremental,
+    )
+
+    if path is None:
+        click.echo('数据库没有变化，跳过备份。')
+    else:
+        click.echo(f'备份到 {path}')
+
+@click.command('restore')
+@click.argument('path', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--pages', default=100, show_default=True, help='每一步复制的页数。')
+@click.option('--sleep', default=0.0, show_default=True,
+              help='两步之间暂停的秒数。恢复期间数据库一直被锁定，暂停只会延长锁定时间。')
+@click.confirmation_option(prompt='恢复会覆盖现有数据，是否继续？')
+def restore_command(path, pages, sleep):
+    """从备份恢复数据库，缺省使用最近一次备份"""
+    if path is None:
+        backups = list_backups(current_app.config['BACKUP_DIR'])
+        if not backups:
+            raise click.ClickException('没有找到备份。')
+        path = backups[-1]
+
+    restore_db(current_app.config['DATABASE'], path, pages=pages, sleep=sleep)
+    click.echo(f'从 {path} 恢复数据库。')
+
 #####
 # 在应用中注册
 #####
@@ -89,6 +447,14 @@ def init_app(app):
 
     # app.cli.add_command() 添加一个新的 可以与 flask 一起工作的命令。
     app.cli.add_command(init_db_command)
+    app.cli.add_command(db_maintain_command)
+    app.cli.add_command(backup_command)
+    app.cli.add_command(restore_command)
+
+    # 测试时不启动后台维护线程。
+    # 调度器在第一个请求时才启动，见 start_maintenance 。
+    if app.config['DB_MAINTENANCE_INTERVAL'] and not app.testing:
+        start_maintenance(app)
 
 # 在工厂中导入并调用这个函数。在工厂函数中把新的代码放到 函数的尾部，返回应用代码的前面。
 # 见 __init__.py
\ No newline at end of file
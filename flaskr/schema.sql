@@ -2,9 +2,19 @@
  * 创建表
  */
 
+-- auto_vacuum 必须在建表之前设置，之后才能用 PRAGMA incremental_vacuum 回收空闲页。
+-- 对已经存在的数据库文件，需要 VACUUM 之后才会生效。
+PRAGMA auto_vacuum = INCREMENTAL;
+
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS post;
 
+VACUUM;
+
+-- WAL 模式下读和写不会相互阻塞，这个设置保存在数据库文件中。
+-- -wal 文件由 flask db-maintain 和后台维护线程做检查点。
+PRAGMA journal_mode = WAL;
+
 CREATE TABLE user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   username TEXT UNIQUE NOT NULL,
@@ -0,0 +1,46 @@
+##########
+# 缓存 URL 构建
+##########
+
+# 模板每次渲染都会多次调用 url_for() ，每一次都要在 Werkzeug 的 URL map 中查找并构建 URL 。
+# 对于没有参数，或者只有简单参数的端点，同样的输入总是得到同样的 URL ，因此可以缓存结果。
+
+import functools
+
+from flask import has_request_context, request, url_for
+
+def init_app(app):
+    maxsize = app.config['URL_CACHE_SIZE']
+
+    # 缓存属于这个应用，不同的应用实例之间互不影响。
+    # script_root 是应用挂载的路径，它也是 URL 的一部分，所以放在缓存键中。
+    @functools.lru_cache(maxsize=maxsize)
+    def build(script_root, endpoint, items):
+        return url_for(endpoint, **{k: v for k, _, v in items})
+
+    def cached_url_for(endpoint, **values):
+        """和 url_for() 用法相同，结果会被缓存。
+        """
+        # 相对端点（ '.login' ）依赖当前蓝图，以 _ 开头的参数（ _external 、 _anchor 等）
+        # 依赖请求的主机和协议，这些情况直接交给 url_for() 。
+        if endpoint.startswith('.') or any(k.startswith('_') for k in values):
+            return url_for(endpoint, **values)
+
+        # True == 1 == 1.0 ，它们的哈希值也相同，但构建出的 URL 不同，所以值的类型也放在缓存键中。
+        items = tuple((k, type(v), v) for k, v in sorted(values.items()))
+
+        try:
+            hash(items)
+        except TypeError:
+            # 列表之类的参数不能作为缓存键。
+            return url_for(endpoint, **values)
+
+        # 没有请求时（例如在应用上下文中渲染） url_for() 使用 SERVER_NAME 和 APPLICATION_ROOT 。
+        script_root = request.script_root if has_request_context() else None
+        return build(script_root, endpoint, items)
+
+    cached_url_for.cache_info = build.cache_info
+    cached_url_for.cache_clear = build.cache_clear
+
+    # 替换模板中的 url_for ，模板本身不需要修改。
+    app.jinja_env.globals['url_for'] = cached_url_for